@@ -1,6 +1,6 @@
 from nicegui import ui
 from typing import List, Optional, Callable
-from app.models import NutritionalAnalysis
+from app.models import NutritionalAnalysisSummary
 from app.services.nutrition_service import NutritionAnalysisService
 
 
@@ -11,7 +11,7 @@ class HistoryComponent:
         self.on_select = on_select
         self.nutrition_service = NutritionAnalysisService()
 
-    def create_history_display(self, analyses: List[NutritionalAnalysis]):
+    def create_history_display(self, analyses: List[NutritionalAnalysisSummary]):
         """Create history display with analysis cards."""
         if not analyses:
             self._create_empty_state()
@@ -30,7 +30,7 @@ class HistoryComponent:
             ui.label("No analyses yet").classes("text-xl font-semibold text-gray-600 mb-2")
             ui.label("Upload your first food image to get started!").classes("text-gray-500")
 
-    def _create_history_card(self, analysis: NutritionalAnalysis):
+    def _create_history_card(self, analysis: NutritionalAnalysisSummary):
         """Create a single history card."""
         # Determine card styling based on status
         status_styles = {
@@ -134,7 +134,7 @@ class HistoryComponent:
         else:
             return "text-red-600"
 
-    def create_compact_history(self, analyses: List[NutritionalAnalysis], limit: int = 5):
+    def create_compact_history(self, analyses: List[NutritionalAnalysisSummary], limit: int = 5):
         """Create a compact history view for sidebar or dashboard."""
         recent_analyses = analyses[:limit]
 
@@ -152,7 +152,7 @@ class HistoryComponent:
                 for analysis in recent_analyses:
                     self._create_compact_analysis_item(analysis)
 
-    def _create_compact_analysis_item(self, analysis: NutritionalAnalysis):
+    def _create_compact_analysis_item(self, analysis: NutritionalAnalysisSummary):
         """Create a compact analysis item for sidebar."""
         with ui.row().classes("items-center justify-between w-full p-2 hover:bg-gray-50 rounded"):
             with ui.column().classes("flex-1"):
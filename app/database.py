@@ -1,4 +1,5 @@
 import os
+from sqlalchemy import text
 from sqlmodel import SQLModel, create_engine, Session
 
 # Import all models to ensure they're registered. ToDo: replace with specific imports when possible.
@@ -8,8 +9,15 @@ DATABASE_URL = os.environ.get("APP_DATABASE_URL", "postgresql://postgres:postgre
 ENGINE = create_engine(DATABASE_URL, connect_args={"connect_timeout": 15, "options": "-c statement_timeout=1000"})
 
 
+# Columns added to existing tables after their first release; create_all never alters tables that already exist
+_COLUMN_MIGRATIONS = ("ALTER TABLE food_images ADD COLUMN IF NOT EXISTS file_path_analysis VARCHAR(500)",)
+
+
 def create_tables():
     SQLModel.metadata.create_all(ENGINE)
+    with ENGINE.begin() as conn:
+        for statement in _COLUMN_MIGRATIONS:
+            conn.execute(text(statement))
 
 
 def get_session():
@@ -1,7 +1,40 @@
 """Stub for DBRX client when not available."""
 
+import json
 import logging
 
+# Placeholder analysis returned for every image; serialized once at import time
+_STUB_RESULT = {
+    "food_items": ["unknown food"],
+    "confidence_score": 0.1,
+    "nutritional_info": {
+        "calories": 0,
+        "protein_g": 0,
+        "carbohydrates_g": 0,
+        "total_fat_g": 0,
+    },
+    "allergens": [],
+}
+_STUB_CONTENT = json.dumps(_STUB_RESULT)
+
+
+class MockMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+
+class MockChoice:
+    def __init__(self, message: MockMessage):
+        self.message = message
+
+
+class MockResponse:
+    def __init__(self, choices: list[MockChoice]):
+        self.choices = choices
+
+
+_STUB_RESPONSE = MockResponse([MockChoice(MockMessage(_STUB_CONTENT))])
+
 
 class DbrxStub:
     """Stub DBRX client for testing/development."""
@@ -23,32 +56,19 @@ class CompletionsStub:
     def create(self, **kwargs):
         """Return mock response."""
         logging.warning("Using DBRX stub - returning mock response")
-
-        class MockChoice:
-            def __init__(self):
-                self.message = MockMessage()
-
-        class MockMessage:
-            def __init__(self):
-                self.content = """
-                {
-                    "food_items": ["unknown food"],
-                    "confidence_score": 0.1,
-                    "nutritional_info": {
-                        "calories": 0,
-                        "protein_g": 0,
-                        "carbohydrates_g": 0,
-                        "total_fat_g": 0
-                    },
-                    "allergens": []
-                }
-                """
-
-        class MockResponse:
-            def __init__(self):
-                self.choices = [MockChoice()]
-
-        return MockResponse()
+        image_count = sum(
+            1
+            for message in kwargs.get("messages", [])
+            for part in message.get("content", [])
+            if isinstance(part, dict) and part.get("type") == "image_url"
+        )
+
+        # Batch requests carry several images and expect one result per image
+        if image_count > 1:
+            content = json.dumps({"results": [_STUB_RESULT] * image_count})
+            return MockResponse([MockChoice(MockMessage(content))])
+
+        return _STUB_RESPONSE
 
 
 def get_dbrx_client():
@@ -39,6 +39,7 @@ class FoodImage(SQLModel, table=True):
     filename: str = Field(max_length=255)
     original_filename: str = Field(max_length=255)
     file_path: str = Field(max_length=500)
+    file_path_analysis: Optional[str] = Field(default=None, max_length=500)  # downscaled JPEG for AI analysis
     file_size: int = Field(gt=0)  # in bytes
     mime_type: str = Field(max_length=100, default="image/jpeg")
     source_type: ImageSourceType = Field(default=ImageSourceType.UPLOAD)
@@ -139,6 +140,7 @@ class FoodImageCreate(SQLModel, table=False):
     filename: str = Field(max_length=255)
     original_filename: str = Field(max_length=255)
     file_path: str = Field(max_length=500)
+    file_path_analysis: Optional[str] = Field(default=None, max_length=500)
     file_size: int = Field(gt=0)
     mime_type: str = Field(max_length=100, default="image/jpeg")
     source_type: ImageSourceType = Field(default=ImageSourceType.UPLOAD)
@@ -243,6 +245,21 @@ class NutritionalAnalysisResponse(SQLModel, table=False):
     updated_at: str
 
 
+class NutritionalAnalysisSummary(SQLModel, table=False):
+    """Lightweight analysis row for history listings (no vitamin/mineral JSON)."""
+
+    id: int
+    status: AnalysisStatus
+    food_items: List[str]
+    confidence_score: Optional[Decimal]
+    calories: Optional[Decimal]
+    protein_g: Optional[Decimal]
+    total_fat_g: Optional[Decimal]
+    processing_time_ms: Optional[int]
+    error_message: Optional[str]
+    created_at: datetime
+
+
 class AllergenResponse(SQLModel, table=False):
     id: int
     name: str
@@ -97,7 +97,10 @@ def create():
             # Create food image record
             from app.models import ImageSourceType
 
-            food_image = user_service.create_food_image(user_id, content, filename, ImageSourceType.UPLOAD)
+            # Saving and resizing the upload is blocking work, keep it off the event loop
+            food_image = await asyncio.to_thread(
+                user_service.create_food_image, user_id, content, filename, ImageSourceType.UPLOAD
+            )
 
             if not food_image:
                 with container:
@@ -109,7 +112,7 @@ def create():
 
             # Analyze the image
             if food_image.id is not None:
-                analysis = nutrition_service.analyze_food_image(food_image.id)
+                analysis = await nutrition_service.analyze_food_image(food_image.id)
 
                 if analysis and analysis.id is not None:
                     # Get allergen detections
@@ -10,6 +10,7 @@ class FileService:
     ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
     MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
     MAX_IMAGE_SIZE = (2048, 2048)  # Max width/height
+    ANALYSIS_IMAGE_SIZE = (1024, 1024)  # Max width/height of the copy sent for AI analysis
 
     def __init__(self):
         self.UPLOAD_DIR.mkdir(exist_ok=True)
@@ -65,10 +66,33 @@ class FileService:
 
         return unique_filename, str(file_path), file_size, width, height
 
+    def save_analysis_image(self, file_path: str) -> str:
+        """
+        Save a JPEG copy of a stored image capped at ANALYSIS_IMAGE_SIZE and return its path.
+        Returns the original path when it is already a small enough JPEG.
+        """
+        source_path = Path(file_path)
+        with Image.open(source_path) as img:
+            max_width, max_height = self.ANALYSIS_IMAGE_SIZE
+            if img.format == "JPEG" and img.size[0] <= max_width and img.size[1] <= max_height:
+                return file_path
+
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+
+            img.thumbnail(self.ANALYSIS_IMAGE_SIZE, Image.Resampling.LANCZOS)
+
+            analysis_path = self._get_analysis_path(source_path)
+            img.save(analysis_path, format="JPEG", optimize=True, quality=85)
+
+        return str(analysis_path)
+
     def delete_image(self, file_path: str) -> bool:
-        """Delete an image file. Returns True if successful."""
+        """Delete an image file and its analysis copy, if any. Returns True if successful."""
         try:
-            Path(file_path).unlink(missing_ok=True)
+            path = Path(file_path)
+            path.unlink(missing_ok=True)
+            self._get_analysis_path(path).unlink(missing_ok=True)
             return True
         except Exception as e:
             import logging
@@ -82,3 +106,7 @@ class FileService:
         if file_path.exists():
             return str(file_path)
         return None
+
+    def _get_analysis_path(self, file_path: Path) -> Path:
+        """Get the path of the analysis copy for a stored image."""
+        return file_path.with_name(f"{file_path.stem}_analysis.jpg")
@@ -1,9 +1,31 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import re
+import threading
 import time
+from collections import OrderedDict
+from datetime import datetime
 from decimal import Decimal
-from typing import Dict, List, Optional, Any, Tuple
-from sqlmodel import Session, select
+from typing import Dict, Iterable, List, Optional, Any, Tuple
+import aiofiles
+import aiofiles.os
+import aiohttp
+from sqlalchemy import delete, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, desc, select
 from app.database import get_session
-from app.models import NutritionalAnalysis, AllergenDetection, Allergen, FoodImage, AnalysisStatus
+from app.models import (
+    NutritionalAnalysis,
+    NutritionalAnalysisSummary,
+    AllergenDetection,
+    Allergen,
+    FoodImage,
+    AnalysisStatus,
+)
 
 try:
     from app.dbrx import get_dbrx_client  # type: ignore[import-untyped]
@@ -11,90 +33,45 @@ try:
     _DBRX_AVAILABLE = True
 except ImportError:
     # For testing without DBRX dependency, use stub
-    import logging
-
     logging.warning("DBRX client not available, using stub")
     from app.dbrx_stub import get_dbrx_client  # type: ignore[import-untyped]
 
     _DBRX_AVAILABLE = False
 
+try:
+    import orjson
 
-class NutritionAnalysisService:
-    """Service for analyzing food images and extracting nutritional information."""
-
-    def __init__(self):
-        self.dbrx_client = get_dbrx_client()
-
-    def analyze_food_image(self, food_image_id: int) -> Optional[NutritionalAnalysis]:
-        """
-        Analyze a food image using AI and create nutritional analysis.
-        Returns the analysis record or None if failed.
-        """
-        with get_session() as session:
-            # Get the food image
-            food_image = session.get(FoodImage, food_image_id)
-            if not food_image:
-                return None
-
-            # Create initial analysis record
-            analysis = NutritionalAnalysis(
-                food_image_id=food_image_id, status=AnalysisStatus.PROCESSING, ai_model_used="dbrx-instruct"
-            )
-            session.add(analysis)
-            session.commit()
-            session.refresh(analysis)
-
-            try:
-                start_time = time.time()
-
-                # Analyze the image using DBRX
-                analysis_result = self._analyze_with_ai(food_image.file_path)
-
-                processing_time = int((time.time() - start_time) * 1000)
-
-                if analysis_result:
-                    # Update analysis with results
-                    self._update_analysis_with_results(session, analysis, analysis_result, processing_time)
-
-                    # Create allergen detections
-                    self._create_allergen_detections(session, analysis, analysis_result.get("allergens", []))
-
-                    analysis.status = AnalysisStatus.COMPLETED
-                else:
-                    analysis.status = AnalysisStatus.FAILED
-                    analysis.error_message = "Failed to analyze image with AI"
-
-                analysis.processing_time_ms = processing_time
-                session.commit()
-                session.refresh(analysis)
-
-                return analysis
-
-            except Exception as e:
-                import logging
-
-                logging.error(f"Analysis failed: {e}")
-                analysis.status = AnalysisStatus.FAILED
-                analysis.error_message = str(e)[:1000]
-                session.commit()
-                session.refresh(analysis)
-                return analysis
-
-    def _analyze_with_ai(self, image_path: str) -> Optional[Dict[str, Any]]:
-        """Use DBRX to analyze the food image."""
-        # Read image as base64
-        import base64
-
-        try:
-            with open(image_path, "rb") as image_file:
-                image_data = base64.b64encode(image_file.read()).decode()
-        except Exception as e:
-            import logging
-
-            logging.error(f"Failed to read image file {image_path}: {e}")
-            return None
-
-        prompt = """
+    _json_loads = orjson.loads
+except ImportError:
+    # orjson ships no wheels for 32-bit x86
+    _json_loads = json.loads
+
+# Direct HTTP access to the DBRX chat completions endpoint (OpenAI-compatible)
+DBRX_MODEL = "dbrx-instruct"
+DBRX_URL = os.environ.get("DBRX_URL", "")
+DBRX_TOKEN = os.environ.get("DATABRICKS_TOKEN", "")
+DBRX_TIMEOUT_S = 120
+
+# Per-100g nutrient keys shared by the AI response and NutritionalAnalysis
+_NUTRI_FIELDS = (
+    "calories",
+    "protein_g",
+    "carbohydrates_g",
+    "total_fat_g",
+    "saturated_fat_g",
+    "fiber_g",
+    "sugar_g",
+    "sodium_mg",
+)
+
+# Scalar result columns reset before an analysis is re-run
+_RESULT_FIELDS = _NUTRI_FIELDS + ("confidence_score", "estimated_portion_g", "total_calories", "processing_time_ms")
+
+# Columns loaded for history listings, matching NutritionalAnalysisSummary
+_SUMMARY_COLUMNS = tuple(getattr(NutritionalAnalysis, field) for field in NutritionalAnalysisSummary.model_fields)
+
+# Instructions sent along with every food image
+_ANALYSIS_PROMPT = """
         Analyze this food image and provide detailed nutritional information. Return a JSON response with the following structure:
         {
             "food_items": ["list of identified food items"],
@@ -134,50 +111,437 @@ class NutritionAnalysisService:
         All nutritional values should be per 100g unless otherwise specified.
         """
 
-        try:
-            if self.dbrx_client is None:
-                import logging
+# Prepended to the analysis prompt when several images are sent in one request
+_BATCH_PROMPT_HEADER = """
+        You are given {count} food images. Analyze each image separately, following the instructions below.
+        Return a single JSON object of the form {{"results": [...]}}, where "results" holds exactly one
+        analysis object per image, in the same order as the images.
+        """
 
-                logging.warning("DBRX client not available for image analysis")
+# Images per batch request; keeps prompt size and completion budget (2000 tokens per image) bounded
+_BATCH_SIZE = 4
+
+# JSON object in the model reply: a fenced block (```json ... ```) wins over braces anywhere in the prose
+_FENCED_JSON_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.S)
+_BARE_JSON_RE = re.compile(r"\{.*\}", re.S)
+
+
+class _RequestSlots:
+    """Caps in-flight DBRX requests across the whole process, whichever event loop they run on."""
+
+    def __init__(self, limit: int) -> None:
+        # asyncio.Semaphore is bound to one loop; analyze_food_image_sync callers each run their own
+        self._slots = threading.BoundedSemaphore(limit)
+
+    async def __aenter__(self) -> None:
+        while not self._slots.acquire(blocking=False):
+            await asyncio.sleep(0.01)
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self._slots.release()
+
+
+_DBRX_SLOTS = _RequestSlots(5)
+
+# Shared DBRX HTTP session of the app's event loop, so TCP/TLS connections are reused across analyses
+_HTTP_SESSION: Optional[aiohttp.ClientSession] = None
+
+
+def _new_http_session() -> aiohttp.ClientSession:
+    """Create a DBRX HTTP session with a keep-alive connection pool."""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=10, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(total=DBRX_TIMEOUT_S),
+    )
+
+
+def _get_http_session() -> aiohttp.ClientSession:
+    """Return the shared DBRX HTTP session, creating it on first use."""
+    global _HTTP_SESSION
+
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed:
+        _HTTP_SESSION = _new_http_session()
+    return _HTTP_SESSION
+
+
+async def close_http_session() -> None:
+    """Close the shared DBRX HTTP session. Registered as an app shutdown hook."""
+    global _HTTP_SESSION
+
+    if _HTTP_SESSION is not None:
+        await _HTTP_SESSION.close()
+    _HTTP_SESSION = None
+
+
+async def _read_image(image_path: str) -> bytes:
+    """Read an image file without blocking the event loop (aiofiles runs the read in a worker thread)."""
+    async with aiofiles.open(image_path, "rb") as image_file:
+        return await image_file.read()
+
+
+# Base64 image payloads keyed by (file_path, mtime); rewriting a file invalidates its entry
+_B64_CACHE: "OrderedDict[Tuple[str, float], str]" = OrderedDict()
+_B64_CACHE_SIZE = 128
+
+
+async def _read_b64(image_path: str) -> str:
+    """Return the base64-encoded contents of an image file, reusing recent encodings."""
+    key = (image_path, (await aiofiles.os.stat(image_path)).st_mtime)
+    cached = _B64_CACHE.get(key)
+    if cached is not None:
+        _B64_CACHE.move_to_end(key)
+        return cached
+
+    image_data = base64.b64encode(await _read_image(image_path)).decode()
+
+    _B64_CACHE[key] = image_data
+    if len(_B64_CACHE) > _B64_CACHE_SIZE:
+        _B64_CACHE.popitem(last=False)
+    return image_data
+
+
+# Allergen name -> id; the vocabulary is small and rows are never renamed
+_ALLERGEN_CACHE: Dict[str, int] = {}
+
+
+def clear_allergen_cache() -> None:
+    """Forget cached allergen IDs, e.g. after allergens were deleted or the database was reset."""
+    _ALLERGEN_CACHE.clear()
+
+
+def _extract_json(response_text: str) -> str:
+    """Return the JSON object embedded in a model reply, or the reply itself if none is found."""
+    m = _FENCED_JSON_RE.search(response_text)
+    if m:
+        return m.group(1)
+    m = _BARE_JSON_RE.search(response_text)
+    return m.group(0) if m else response_text
+
+
+class NutritionAnalysisService:
+    """Service for analyzing food images and extracting nutritional information."""
+
+    def __init__(self, dbrx_url: str = DBRX_URL, dbrx_token: str = DBRX_TOKEN):
+        self.dbrx_client = get_dbrx_client()
+        # When set, requests go straight to this chat completions endpoint instead of the client
+        self.dbrx_url = dbrx_url
+        self.dbrx_token = dbrx_token
+
+    def analyze_food_image_sync(self, food_image_id: int) -> Optional[NutritionalAnalysis]:
+        """Blocking wrapper around analyze_food_image for callers outside an event loop."""
+
+        async def run() -> Optional[NutritionalAnalysis]:
+            # asyncio.run starts a fresh loop, which can't use the app's shared session; use one of its own
+            async with _new_http_session() as http_session:
+                return await self.analyze_food_image(food_image_id, http_session)
+
+        return asyncio.run(run())
+
+    async def analyze_food_image(
+        self, food_image_id: int, http_session: Optional[aiohttp.ClientSession] = None
+    ) -> Optional[NutritionalAnalysis]:
+        """
+        Analyze a food image using AI and create nutritional analysis.
+        DBRX requests go through `http_session`, or the shared session if none is given.
+        Returns the analysis record or None if failed.
+        """
+        # Database work runs in worker threads so the event loop stays free for other users
+        with get_session() as session:
+            # Keep committed values in memory so the returned analysis needs no reload
+            session.expire_on_commit = False
+
+            # Get the food image
+            food_image = await asyncio.to_thread(session.get, FoodImage, food_image_id)
+            if not food_image:
                 return None
-            response = self.dbrx_client.chat.completions.create(
-                model="dbrx-instruct",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}},
-                        ],
-                    }
-                ],
-                max_tokens=2000,
-                temperature=0.1,
+
+            start_time = time.time()
+
+            # Read the image while the initial analysis record is being committed
+            request_task = asyncio.create_task(
+                self._prepare_request(food_image.file_path_analysis or food_image.file_path)
+            )
+            analysis = NutritionalAnalysis(food_image_id=food_image_id)
+            request, _ = await asyncio.gather(
+                request_task, asyncio.to_thread(self._persist_processing, session, [analysis])
             )
 
-            # Parse JSON response
-            import json
+            try:
+                # Analyze the image using DBRX
+                analysis_result = await self._analyze_with_ai(request, http_session)
+
+                processing_time = int((time.time() - start_time) * 1000)
 
-            response_text = response.choices[0].message.content.strip()
+                await asyncio.to_thread(self._persist_results, session, [(analysis, analysis_result)], processing_time)
+                return analysis
+
+            except Exception as e:
+                logging.error(f"Analysis failed: {e}")
+                await asyncio.to_thread(self._persist_failure, session, [analysis], str(e))
+                return analysis
+
+    async def analyze_food_images(self, food_image_ids: List[int]) -> List[Optional[NutritionalAnalysis]]:
+        """
+        Analyze several food images, sending up to _BATCH_SIZE images per DBRX request.
+        Existing analyses of these images are re-run in place.
+        Returns one analysis per requested ID, in order, with None for unknown images.
+        """
+        if not food_image_ids:
+            return []
+
+        with get_session() as session:
+            session.expire_on_commit = False
+            food_images, analyses = await asyncio.to_thread(self._load_batch, session, food_image_ids)
+            if not food_images:
+                return [None] * len(food_image_ids)
 
-            # Extract JSON from response if it's wrapped in markdown
-            if "```json" in response_text:
-                json_start = response_text.find("```json") + 7
-                json_end = response_text.find("```", json_start)
-                response_text = response_text[json_start:json_end].strip()
-            elif "```" in response_text:
-                json_start = response_text.find("```") + 3
-                json_end = response_text.rfind("```")
-                response_text = response_text[json_start:json_end].strip()
+            start_time = time.time()
 
-            return json.loads(response_text)
+            # Read all images while the analysis records are being committed
+            read_tasks = [
+                asyncio.create_task(_read_b64(food_image.file_path_analysis or food_image.file_path))
+                for food_image in food_images.values()
+            ]
+            images_b64, _ = await asyncio.gather(
+                asyncio.gather(*read_tasks, return_exceptions=True),
+                asyncio.to_thread(self._persist_processing, session, list(analyses.values())),
+            )
 
+            try:
+                # Images that could not be read are left out of the request and fail below
+                readable = [
+                    (food_image_id, image_data)
+                    for food_image_id, image_data in zip(food_images, images_b64)
+                    if isinstance(image_data, str)
+                ]
+                chunks = [readable[i : i + _BATCH_SIZE] for i in range(0, len(readable), _BATCH_SIZE)]
+                chunk_results = await asyncio.gather(
+                    *(self._analyze_batch_with_ai([image_data for _, image_data in chunk]) for chunk in chunks)
+                )
+                results = {
+                    food_image_id: result
+                    for chunk, batch_results in zip(chunks, chunk_results)
+                    for (food_image_id, _), result in zip(chunk, batch_results)
+                }
+
+                processing_time = int((time.time() - start_time) * 1000)
+
+                await asyncio.to_thread(
+                    self._persist_results,
+                    session,
+                    [(analysis, results.get(food_image_id)) for food_image_id, analysis in analyses.items()],
+                    processing_time,
+                )
+
+            except Exception as e:
+                logging.error(f"Batch analysis failed: {e}")
+                await asyncio.to_thread(self._persist_failure, session, list(analyses.values()), str(e))
+
+            return [analyses.get(food_image_id) for food_image_id in food_image_ids]
+
+    def _load_batch(
+        self, session: Session, food_image_ids: List[int]
+    ) -> Tuple[Dict[int, FoodImage], Dict[int, NutritionalAnalysis]]:
+        """Load the requested food images and their existing (or new) analysis records, keyed by image ID."""
+        stmt = select(FoodImage).where(FoodImage.id.in_(food_image_ids))  # type: ignore[union-attr]
+        food_images = {food_image.id: food_image for food_image in session.exec(stmt).all() if food_image.id}
+
+        stmt = select(NutritionalAnalysis).where(
+            NutritionalAnalysis.food_image_id.in_(food_images.keys())  # type: ignore[attr-defined]
+        )
+        existing = {analysis.food_image_id: analysis for analysis in session.exec(stmt).all()}
+        analyses = {
+            food_image_id: existing.get(food_image_id) or NutritionalAnalysis(food_image_id=food_image_id)
+            for food_image_id in food_images
+        }
+        return food_images, analyses
+
+    def _persist_processing(self, session: Session, analyses: List[NutritionalAnalysis]) -> None:
+        """Mark analysis records as PROCESSING and commit them so they get IDs."""
+        stale_ids = [analysis.id for analysis in analyses if analysis.id is not None]
+        if stale_ids:
+            # Re-analysis replaces the earlier allergen detections
+            stmt = delete(AllergenDetection).where(
+                AllergenDetection.nutritional_analysis_id.in_(stale_ids)  # type: ignore[attr-defined]
+            )
+            session.exec(stmt)  # type: ignore[call-overload]
+
+        for analysis in analyses:
+            # Drop results of an earlier run so a failed re-analysis leaves no stale values behind
+            for field in _RESULT_FIELDS:
+                setattr(analysis, field, None)
+            analysis.food_items = []
+            analysis.vitamins = {}
+            analysis.minerals = {}
+            analysis.status = AnalysisStatus.PROCESSING
+            analysis.ai_model_used = DBRX_MODEL
+            analysis.error_message = None
+
+        session.add_all(analyses)
+        session.commit()
+        for analysis in analyses:
+            session.refresh(analysis)
+
+    def _persist_results(
+        self,
+        session: Session,
+        results: List[Tuple[NutritionalAnalysis, Optional[Dict[str, Any]]]],
+        processing_time: int,
+    ) -> None:
+        """Store AI results (or their absence) on the analysis records in a single commit."""
+        allergen_ids: Dict[str, int] = {}
+        for analysis, analysis_result in results:
+            allergen_ids.update(self._apply_analysis_result(session, analysis, analysis_result, processing_time))
+        session.commit()
+
+        # Only cache IDs once they are committed
+        _ALLERGEN_CACHE.update(allergen_ids)
+
+    def _persist_failure(self, session: Session, analyses: List[NutritionalAnalysis], error: str) -> None:
+        """Mark analysis records as FAILED with the given error and commit."""
+        # Discard whatever the failed step left behind (e.g. a failed flush) so the session is usable again
+        session.rollback()
+        for analysis in analyses:
+            analysis.status = AnalysisStatus.FAILED
+            analysis.error_message = error[:1000]
+        session.commit()
+        # Rollback expired the records; reload them so callers can read them after the session closes
+        for analysis in analyses:
+            session.refresh(analysis)
+
+    def _apply_analysis_result(
+        self,
+        session: Session,
+        analysis: NutritionalAnalysis,
+        analysis_result: Optional[Dict[str, Any]],
+        processing_time: int,
+    ) -> Dict[str, int]:
+        """Store an AI result (or its absence) on the analysis record. Returns the allergen IDs it used."""
+        allergen_ids: Dict[str, int] = {}
+        if analysis_result:
+            # Update analysis with results
+            self._update_analysis_with_results(session, analysis, analysis_result, processing_time)
+
+            # Create allergen detections
+            allergen_ids = self._create_allergen_detections(session, analysis, analysis_result.get("allergens", []))
+
+            analysis.status = AnalysisStatus.COMPLETED
+        else:
+            analysis.status = AnalysisStatus.FAILED
+            analysis.error_message = "Failed to analyze image with AI"
+            analysis.processing_time_ms = processing_time
+        return allergen_ids
+
+    async def _prepare_request(self, image_path: str) -> Optional[Dict[str, Any]]:
+        """Read the image and build the DBRX request body. Returns None if the file can't be read."""
+        try:
+            return self._build_json_request(await _read_b64(image_path), _ANALYSIS_PROMPT)
         except Exception as e:
-            import logging
+            logging.error(f"Failed to read image file {image_path}: {e}")
+            return None
+
+    async def _analyze_with_ai(
+        self, request: Optional[Dict[str, Any]], http_session: Optional[aiohttp.ClientSession] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Use DBRX to analyze the food image."""
+        if request is None:
+            return None
 
+        try:
+            if self.dbrx_client is None:
+                logging.warning("DBRX client not available for image analysis")
+                return None
+
+            # Parse JSON response
+            response_text = await self._complete(request, http_session)
+
+            # Extract JSON from response if it's wrapped in markdown or prose
+            return _json_loads(_extract_json(response_text))
+
+        except Exception as e:
             logging.error(f"Error analyzing image with AI: {e}")
             return None
 
+    async def _analyze_batch_with_ai(self, images_b64: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """Use one DBRX request to analyze several food images. Results are aligned with the input."""
+        if not images_b64:
+            return []
+
+        if self.dbrx_client is None:
+            logging.warning("DBRX client not available for image analysis")
+            return [None] * len(images_b64)
+
+        prompt = _BATCH_PROMPT_HEADER.format(count=len(images_b64)) + _ANALYSIS_PROMPT
+        content: List[Dict[str, Any]] = [{"type": "text", "text": prompt}]
+        content.extend(
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
+            for image_data in images_b64
+        )
+        payload = {
+            "model": DBRX_MODEL,
+            "messages": [{"role": "user", "content": content}],
+            "max_tokens": 2000 * len(images_b64),
+            "temperature": 0.1,
+        }
+
+        try:
+            parsed = _json_loads(_extract_json(await self._complete(payload)))
+            results = parsed.get("results")
+            if results is None and len(images_b64) == 1:
+                # A single image may come back unwrapped
+                results = [parsed]
+            if not isinstance(results, list):
+                raise ValueError("Batch response has no results list")
+
+            # Map results back by position; missing or malformed entries count as failures
+            return [
+                result if isinstance(result, dict) else None
+                for result in (results + [None] * len(images_b64))[: len(images_b64)]
+            ]
+
+        except Exception as e:
+            logging.error(f"Error analyzing image batch with AI: {e}")
+            return [None] * len(images_b64)
+
+    def _build_json_request(self, image_data: str, prompt: str) -> Dict[str, Any]:
+        """Build a chat completion request with the image inlined as a base64 data URL."""
+        payload = {
+            "model": DBRX_MODEL,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}},
+                    ],
+                }
+            ],
+            "max_tokens": 2000,
+            "temperature": 0.1,
+        }
+        return payload
+
+    async def _complete(self, request: Dict[str, Any], http_session: Optional[aiohttp.ClientSession] = None) -> str:
+        """Send a chat completion request to DBRX and return the message content."""
+        if self.dbrx_url:
+            headers = {"Authorization": f"Bearer {self.dbrx_token}"}
+            s = http_session or _get_http_session()
+            async with _DBRX_SLOTS:
+                async with s.post(self.dbrx_url, headers=headers, json=request) as r:
+                    r.raise_for_status()
+                    body = await r.json()
+            return body["choices"][0]["message"]["content"]
+
+        if _DBRX_AVAILABLE:
+            # The SDK call blocks on network I/O, so it runs in a worker thread
+            async with _DBRX_SLOTS:
+                response = await asyncio.to_thread(self.dbrx_client.chat.completions.create, **request)
+            return response.choices[0].message.content
+
+        # Stub client answers immediately, no network involved
+        response = self.dbrx_client.chat.completions.create(**request)
+        return response.choices[0].message.content
+
     def _update_analysis_with_results(
         self, session: Session, analysis: NutritionalAnalysis, result: Dict[str, Any], processing_time: int
     ) -> None:
@@ -186,23 +550,16 @@ class NutritionAnalysisService:
         analysis.confidence_score = Decimal(str(result.get("confidence_score", 0.0)))
 
         nutrition = result.get("nutritional_info", {})
-        analysis.calories = Decimal(str(nutrition.get("calories", 0))) if nutrition.get("calories") else None
-        analysis.protein_g = Decimal(str(nutrition.get("protein_g", 0))) if nutrition.get("protein_g") else None
-        analysis.carbohydrates_g = (
-            Decimal(str(nutrition.get("carbohydrates_g", 0))) if nutrition.get("carbohydrates_g") else None
-        )
-        analysis.total_fat_g = Decimal(str(nutrition.get("total_fat_g", 0))) if nutrition.get("total_fat_g") else None
-        analysis.saturated_fat_g = (
-            Decimal(str(nutrition.get("saturated_fat_g", 0))) if nutrition.get("saturated_fat_g") else None
-        )
-        analysis.fiber_g = Decimal(str(nutrition.get("fiber_g", 0))) if nutrition.get("fiber_g") else None
-        analysis.sugar_g = Decimal(str(nutrition.get("sugar_g", 0))) if nutrition.get("sugar_g") else None
-        analysis.sodium_mg = Decimal(str(nutrition.get("sodium_mg", 0))) if nutrition.get("sodium_mg") else None
+        for field in _NUTRI_FIELDS:
+            value = nutrition.get(field)
+            setattr(analysis, field, Decimal(str(value)) if value else None)
 
         portion_g = result.get("estimated_portion_g")
         if portion_g and analysis.calories:
             analysis.estimated_portion_g = Decimal(str(portion_g))
-            analysis.total_calories = (analysis.calories * analysis.estimated_portion_g) / Decimal("100")
+            # Compute in float and convert only the stored value (column keeps 2 decimal places)
+            total_calories = float(analysis.calories) * float(portion_g) / 100.0
+            analysis.total_calories = Decimal(f"{total_calories:.2f}")
 
         analysis.vitamins = result.get("vitamins", {})
         analysis.minerals = result.get("minerals", {})
@@ -210,61 +567,92 @@ class NutritionAnalysisService:
 
     def _create_allergen_detections(
         self, session: Session, analysis: NutritionalAnalysis, detected_allergens: List[Dict[str, Any]]
-    ) -> None:
-        """Create allergen detection records."""
-        for allergen_data in detected_allergens:
-            allergen_name = allergen_data.get("name", "").lower().strip()
-            if not allergen_name:
-                continue
-
-            # Get or create allergen
-            stmt = select(Allergen).where(Allergen.name == allergen_name)
-            allergen = session.exec(stmt).first()
-
-            if not allergen:
-                allergen = Allergen(
-                    name=allergen_name, description=f"Common allergen: {allergen_name}", severity_level="moderate"
-                )
-                session.add(allergen)
-                session.commit()
-                session.refresh(allergen)
-
-            # Create detection record
-            if analysis.id and allergen.id:
-                detection = AllergenDetection(
-                    nutritional_analysis_id=analysis.id,
-                    allergen_id=allergen.id,
-                    confidence_score=Decimal(str(allergen_data.get("confidence", 0.5))),
-                    detected_in=allergen_data.get("detected_in"),
+    ) -> Dict[str, int]:
+        """
+        Create allergen detection records, flushed but not committed.
+        Returns the allergen name -> ID mapping used, for the caller to cache after committing.
+        """
+        if analysis.id is None:
+            return {}
+
+        names = {a.get("name", "").lower().strip() for a in detected_allergens} - {""}
+        if not names:
+            return {}
+
+        # Known allergens come from the cache; resolve the rest in one query and insert what's missing
+        allergen_ids = {name: _ALLERGEN_CACHE[name] for name in names if name in _ALLERGEN_CACHE}
+        unresolved = names - allergen_ids.keys()
+        if unresolved:
+            allergen_ids.update(self._lookup_allergen_ids(session, unresolved))
+
+            missing = sorted(unresolved - allergen_ids.keys())
+            if missing:
+                # Concurrent analyses may add the same name; skip the conflict and read back whichever row won
+                insert_stmt = (
+                    pg_insert(Allergen)
+                    .values(
+                        [
+                            Allergen(
+                                name=name, description=f"Common allergen: {name}", severity_level="moderate"
+                            ).model_dump(exclude={"id"})
+                            for name in missing
+                        ]
+                    )
+                    .on_conflict_do_nothing(index_elements=["name"])
                 )
-                session.add(detection)
+                session.exec(insert_stmt)  # type: ignore[call-overload]
 
-        session.commit()
+                allergen_ids.update(self._lookup_allergen_ids(session, missing))
+
+        detections = [
+            AllergenDetection(
+                nutritional_analysis_id=analysis.id,
+                allergen_id=allergen_id,
+                confidence_score=Decimal(str(allergen_data.get("confidence", 0.5))),
+                detected_in=allergen_data.get("detected_in"),
+            )
+            for allergen_data in detected_allergens
+            if (allergen_id := allergen_ids.get(allergen_data.get("name", "").lower().strip())) is not None
+        ]
+        session.add_all(detections)
+        session.flush()
+        return allergen_ids
+
+    def _lookup_allergen_ids(self, session: Session, names: Iterable[str]) -> Dict[str, int]:
+        """Map allergen names to the IDs of their existing rows."""
+        stmt = select(Allergen.name, Allergen.id).where(Allergen.name.in_(names))  # type: ignore[attr-defined]
+        return {name: allergen_id for name, allergen_id in session.exec(stmt).all() if allergen_id is not None}
 
     def get_analysis_with_allergens(
         self, analysis_id: int
     ) -> Optional[Tuple[NutritionalAnalysis, List[AllergenDetection]]]:
         """Get analysis with associated allergen detections."""
         with get_session() as session:
-            analysis = session.get(NutritionalAnalysis, analysis_id)
+            # Eager-load detections and their allergens: one IN query per relationship level
+            stmt = (
+                select(NutritionalAnalysis)
+                .options(
+                    selectinload(NutritionalAnalysis.allergens).selectinload(AllergenDetection.allergen)  # type: ignore[arg-type]
+                )
+                .where(NutritionalAnalysis.id == analysis_id)
+            )
+            analysis = session.exec(stmt).one_or_none()
             if not analysis:
                 return None
 
-            stmt = select(AllergenDetection).where(AllergenDetection.nutritional_analysis_id == analysis_id)
-            allergen_detections = session.exec(stmt).all()
-
-            # Load allergen data
-            for detection in allergen_detections:
-                allergen = session.get(Allergen, detection.allergen_id)
-                if allergen:
-                    detection.allergen = allergen
-
-            return analysis, list(allergen_detections)
-
-    def get_recent_analyses(self, limit: int = 10) -> List[NutritionalAnalysis]:
-        """Get recent nutritional analyses."""
-        from sqlmodel import desc
+            return analysis, list(analysis.allergens)
 
+    def get_recent_analyses(
+        self, limit: int = 10, before: Optional[Tuple[datetime, int]] = None
+    ) -> List[NutritionalAnalysisSummary]:
+        """
+        Get recent nutritional analyses, newest first, without the vitamin/mineral payloads.
+        Pass (created_at, id) of the last row as `before` to fetch the next page; the id breaks timestamp ties.
+        """
         with get_session() as session:
-            stmt = select(NutritionalAnalysis).order_by(desc(NutritionalAnalysis.created_at)).limit(limit)
-            return list(session.exec(stmt).all())
+            stmt = select(*_SUMMARY_COLUMNS)  # type: ignore[call-overload]
+            if before is not None:
+                cursor = tuple_(NutritionalAnalysis.created_at, NutritionalAnalysis.id)  # type: ignore[arg-type]
+                stmt = stmt.where(cursor < before)
+            stmt = stmt.order_by(desc(NutritionalAnalysis.created_at), desc(NutritionalAnalysis.id)).limit(limit)
+            return [NutritionalAnalysisSummary(**row._asdict()) for row in session.exec(stmt).all()]
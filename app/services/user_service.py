@@ -65,6 +65,9 @@ class UserService:
         try:
             filename, file_path, file_size, width, height = self.file_service.save_image(content, original_filename)
 
+            # Downscaled JPEG sent to the AI model, prepared once instead of on every analysis
+            file_path_analysis = self.file_service.save_analysis_image(file_path)
+
             # Get MIME type
             mime_type = self._get_mime_type(original_filename)
 
@@ -74,6 +77,7 @@ class UserService:
                     filename=filename,
                     original_filename=original_filename,
                     file_path=file_path,
+                    file_path_analysis=file_path_analysis,
                     file_size=file_size,
                     mime_type=mime_type,
                     source_type=source_type,
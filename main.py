@@ -1,6 +1,7 @@
 import logging
 import os
 from app.startup import startup
+from app.services.nutrition_service import close_http_session
 from nicegui import app, ui
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -30,6 +31,7 @@ async def health():
 logging.getLogger("sqlalchemy.engine.Engine").setLevel(logging.WARNING)
 
 app.on_startup(startup)
+app.on_shutdown(close_http_session)
 
 # Add security headers middleware
 app.add_middleware(SecurityHeadersMiddleware)
@@ -72,6 +72,35 @@ def test_large_image_resize_workflow(file_service):
     file_service.delete_image(file_path)
 
 
+def test_analysis_image_workflow(file_service):
+    """Test that a downscaled JPEG copy is prepared for AI analysis."""
+    large_img = Image.new("RGB", (3000, 2000), color="green")
+    byte_arr = BytesIO()
+    large_img.save(byte_arr, format="PNG")
+
+    _, file_path, _, _, _ = file_service.save_image(byte_arr.getvalue(), "large.png")
+    analysis_path = file_service.save_analysis_image(file_path)
+
+    assert analysis_path != file_path
+    with Image.open(analysis_path) as analysis_img:
+        assert analysis_img.format == "JPEG"
+        assert analysis_img.size[0] <= file_service.ANALYSIS_IMAGE_SIZE[0]
+        assert analysis_img.size[1] <= file_service.ANALYSIS_IMAGE_SIZE[1]
+
+    # Deleting the image removes its analysis copy too
+    file_service.delete_image(file_path)
+    assert not Path(analysis_path).exists()
+
+
+def test_small_jpeg_reused_for_analysis(file_service, sample_image_bytes):
+    """Test that small JPEGs are analyzed as-is without a second copy."""
+    _, file_path, _, _, _ = file_service.save_image(sample_image_bytes, "small.jpg")
+
+    assert file_service.save_analysis_image(file_path) == file_path
+
+    file_service.delete_image(file_path)
+
+
 def test_invalid_file_rejection(file_service):
     """Test that invalid files are properly rejected."""
     invalid_data = b"This is not an image"
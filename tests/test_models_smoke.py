@@ -28,6 +28,22 @@ def test_sqlmodel_smoke():
         assert table_name in db_tables, f"Table '{table_name}' not found in database"
 
 
+@pytest.mark.sqlmodel
+def test_create_tables_adds_new_columns():
+    """Tables created before a column was added get it on the next startup."""
+    create_tables()
+    with ENGINE.begin() as conn:
+        conn.execute(text("ALTER TABLE food_images DROP COLUMN file_path_analysis"))
+
+    create_tables()
+
+    with ENGINE.connect() as conn:
+        result = conn.execute(
+            text("SELECT column_name FROM information_schema.columns WHERE table_name = 'food_images'")
+        )
+        assert "file_path_analysis" in {row[0] for row in result}
+
+
 DATABRICKS_HOST = os.environ.get("DATABRICKS_HOST")
 DATABRICKS_TOKEN = os.environ.get("DATABRICKS_TOKEN")
 
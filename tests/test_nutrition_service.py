@@ -0,0 +1,540 @@
+import asyncio
+import base64
+import json
+import os
+import pytest
+from aiohttp import web
+from contextlib import asynccontextmanager
+from decimal import Decimal
+from PIL import Image
+from io import BytesIO
+from app.services import nutrition_service as nutrition_module
+from app.services.user_service import UserService
+from app.services.nutrition_service import (
+    NutritionAnalysisService,
+    _ALLERGEN_CACHE,
+    _B64_CACHE,
+    _extract_json,
+    _new_http_session,
+    _read_b64,
+    clear_allergen_cache,
+    close_http_session,
+)
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel import select
+from app.models import (
+    Allergen,
+    AllergenDetection,
+    AnalysisStatus,
+    FoodImage,
+    ImageSourceType,
+    NutritionalAnalysis,
+)
+from app.database import get_session, reset_db
+
+
+@pytest.fixture()
+def new_db():
+    reset_db()
+    clear_allergen_cache()
+    yield
+    reset_db()
+    clear_allergen_cache()
+
+
+@pytest.fixture
+def nutrition_service():
+    return NutritionAnalysisService()
+
+
+@pytest.fixture
+def make_food_image(new_db):
+    """Factory saving solid-color JPEG food images for one test user; files are removed on teardown."""
+    user_service = UserService()
+    user = user_service.get_or_create_user("nutrition@example.com", "Nutrition Tester")
+    assert user.id is not None
+    user_id = user.id
+    created = []
+
+    def make(color: str = "green", size: tuple[int, int] = (100, 100), filename: str = "meal.jpg") -> FoodImage:
+        byte_arr = BytesIO()
+        Image.new("RGB", size, color=color).save(byte_arr, format="JPEG")
+        food_image = user_service.create_food_image(user_id, byte_arr.getvalue(), filename, ImageSourceType.UPLOAD)
+        assert food_image is not None
+        created.append(food_image)
+        return food_image
+
+    yield make
+
+    for food_image in created:
+        user_service.file_service.delete_image(food_image.file_path)
+
+
+@pytest.fixture
+def food_image(make_food_image):
+    """Food image saved for a fresh user."""
+    return make_food_image("green", (100, 100), "salad.jpg")
+
+
+async def test_analyze_food_image_with_stub(nutrition_service, food_image):
+    """Test analysis completes using the stub DBRX client."""
+    analysis = await nutrition_service.analyze_food_image(food_image.id)
+
+    assert analysis is not None
+    assert analysis.id is not None
+    assert analysis.status == AnalysisStatus.COMPLETED
+    assert analysis.food_items == ["unknown food"]
+    assert analysis.processing_time_ms is not None
+
+
+async def test_analyze_missing_food_image(nutrition_service, new_db):
+    """Test analysis of a non-existent image returns None."""
+    assert await nutrition_service.analyze_food_image(999) is None
+
+
+async def test_analyze_food_image_missing_file(nutrition_service, food_image):
+    """Test analysis fails gracefully when the image file is gone."""
+    UserService().file_service.delete_image(food_image.file_path)
+
+    analysis = await nutrition_service.analyze_food_image(food_image.id)
+
+    assert analysis is not None
+    assert analysis.status == AnalysisStatus.FAILED
+    assert analysis.error_message is not None
+
+
+async def test_create_allergen_detections_reuses_allergens(nutrition_service, food_image):
+    """Test allergens are created once and shared across detections."""
+    analysis = await nutrition_service.analyze_food_image(food_image.id)
+    assert analysis is not None
+
+    detected = [
+        {"name": "Gluten", "confidence": 0.9, "detected_in": "bread"},
+        {"name": " dairy ", "confidence": 0.7, "detected_in": "cheese"},
+        {"name": "gluten", "confidence": 0.6, "detected_in": "croutons"},
+        {"name": "", "confidence": 0.5},
+    ]
+
+    with get_session() as session:
+        db_analysis = session.get(NutritionalAnalysis, analysis.id)
+        assert db_analysis is not None
+        nutrition_service._persist_results(session, [(db_analysis, {"allergens": detected})], 10)
+
+        allergens = session.exec(select(Allergen)).all()
+        assert sorted(a.name for a in allergens) == ["dairy", "gluten"]
+        assert _ALLERGEN_CACHE == {a.name: a.id for a in allergens}
+
+        detections = session.exec(
+            select(AllergenDetection).where(AllergenDetection.nutritional_analysis_id == analysis.id)
+        ).all()
+        assert len(detections) == 3
+
+
+async def test_read_b64_caches_by_mtime(tmp_path):
+    """Test encoded images are reused until the file changes."""
+    image_path = tmp_path / "meal.jpg"
+    image_path.write_bytes(b"first")
+    path = str(image_path)
+
+    assert await _read_b64(path) == base64.b64encode(b"first").decode()
+    assert (path, image_path.stat().st_mtime) in _B64_CACHE
+
+    # Rewrite with a different mtime: stale entry must not be served
+    image_path.write_bytes(b"second")
+    stat = image_path.stat()
+    os.utime(image_path, (stat.st_atime, stat.st_mtime + 10))
+
+    assert await _read_b64(path) == base64.b64encode(b"second").decode()
+
+
+def test_extract_json_from_model_replies():
+    """Test JSON is found in fenced, bare and prose-wrapped replies."""
+    blob = '{"food_items": ["apple"], "nutritional_info": {"calories": 52}}'
+
+    assert _extract_json(f"```json\n{blob}\n```") == blob
+    assert _extract_json(f"```\n{blob}\n```") == blob
+    assert _extract_json(f"  {blob}  ") == blob
+    assert _extract_json(f"Here is the analysis:\n{blob}\nEnjoy!") == blob
+    assert _extract_json("no json here") == "no json here"
+    # Braces in the prose must not shadow the fenced block
+    assert _extract_json(f"Note: values use {{per 100g}}.\n```json\n{blob}\n```") == blob
+
+
+async def test_get_analysis_with_allergens(nutrition_service, food_image):
+    """Test detections are returned with their allergen loaded."""
+    analysis = await nutrition_service.analyze_food_image(food_image.id)
+    assert analysis is not None
+
+    with get_session() as session:
+        db_analysis = session.get(NutritionalAnalysis, analysis.id)
+        assert db_analysis is not None
+        nutrition_service._create_allergen_detections(
+            session, db_analysis, [{"name": "soy", "confidence": 0.8, "detected_in": "tofu"}]
+        )
+        session.commit()
+
+    result = nutrition_service.get_analysis_with_allergens(analysis.id)
+    assert result is not None
+
+    loaded_analysis, detections = result
+    assert loaded_analysis.id == analysis.id
+    assert len(detections) == 1
+    assert detections[0].allergen.name == "soy"
+    assert detections[0].detected_in == "tofu"
+
+
+def test_get_analysis_with_allergens_not_found(nutrition_service, new_db):
+    """Test missing analysis returns None."""
+    assert nutrition_service.get_analysis_with_allergens(999) is None
+
+
+async def test_create_allergen_detections_uses_cache(nutrition_service, food_image):
+    """Test cached allergens are reused without creating new rows."""
+    analysis = await nutrition_service.analyze_food_image(food_image.id)
+    assert analysis is not None
+
+    with get_session() as session:
+        db_analysis = session.get(NutritionalAnalysis, analysis.id)
+        assert db_analysis is not None
+        nutrition_service._persist_results(session, [(db_analysis, {"allergens": [{"name": "eggs"}]})], 10)
+        cached_id = _ALLERGEN_CACHE["eggs"]
+
+        nutrition_service._persist_results(session, [(db_analysis, {"allergens": [{"name": "Eggs"}]})], 10)
+
+        allergens = session.exec(select(Allergen)).all()
+        assert [(a.name, a.id) for a in allergens] == [("eggs", cached_id)]
+
+        detections = session.exec(
+            select(AllergenDetection).where(AllergenDetection.nutritional_analysis_id == analysis.id)
+        ).all()
+        assert {d.allergen_id for d in detections} == {cached_id}
+        assert len(detections) == 2
+
+
+async def test_analyze_food_images_batch(nutrition_service, food_image, make_food_image):
+    """Test several images are analyzed together and results map back by position."""
+    second_image = make_food_image("yellow", (80, 60), "pasta.jpg")
+
+    # The first image already has an analysis; the batch re-runs it in place
+    first_analysis = await nutrition_service.analyze_food_image(food_image.id)
+    assert first_analysis is not None
+
+    analyses = await nutrition_service.analyze_food_images([second_image.id, 999, food_image.id])
+
+    assert len(analyses) == 3
+    assert analyses[1] is None
+    assert analyses[0] is not None and analyses[0].food_image_id == second_image.id
+    assert analyses[2] is not None and analyses[2].id == first_analysis.id
+    assert all(a.status == AnalysisStatus.COMPLETED for a in (analyses[0], analyses[2]))
+
+
+async def test_concurrent_analyses_share_new_allergen(food_image, make_food_image):
+    """Test analyses running at the same time that both find a new allergen each store a detection."""
+    second_image = make_food_image("white", (60, 60), "tahini.jpg")
+
+    async def handler(request: web.Request) -> web.Response:
+        result = {"food_items": ["hummus"], "allergens": [{"name": "sesame", "confidence": 0.9}]}
+        return web.json_response(_completion(json.dumps(result)))
+
+    async with _dbrx_endpoint(handler) as url:
+        service = NutritionAnalysisService(dbrx_url=url)
+        analyses = await asyncio.gather(
+            service.analyze_food_image(food_image.id), service.analyze_food_image(second_image.id)
+        )
+
+    assert all(a is not None and a.status == AnalysisStatus.COMPLETED for a in analyses)
+    with get_session() as session:
+        allergens = session.exec(select(Allergen)).all()
+        assert [a.name for a in allergens] == ["sesame"]
+        detections = session.exec(select(AllergenDetection)).all()
+        assert {d.allergen_id for d in detections} == {allergens[0].id}
+        assert len(detections) == 2
+
+
+async def test_analyze_food_images_empty(nutrition_service, new_db):
+    """Test empty and unknown batches need no AI call."""
+    assert await nutrition_service.analyze_food_images([]) == []
+    assert await nutrition_service.analyze_food_images([998, 999]) == [None, None]
+
+
+async def test_get_recent_analyses_pages_by_cursor(nutrition_service, food_image, make_food_image):
+    """Test recent analyses are summarized newest first and paged with a (created_at, id) cursor."""
+    second_image = make_food_image("orange", (60, 60), "soup.jpg")
+
+    older = await nutrition_service.analyze_food_image(food_image.id)
+    newer = await nutrition_service.analyze_food_image(second_image.id)
+    assert older is not None and newer is not None
+
+    recent = nutrition_service.get_recent_analyses(10)
+    assert [a.id for a in recent] == [newer.id, older.id]
+    assert recent[0].status == AnalysisStatus.COMPLETED
+    assert recent[0].food_items == ["unknown food"]
+
+    first_page = nutrition_service.get_recent_analyses(1)
+    assert [a.id for a in first_page] == [newer.id]
+
+    last = first_page[-1]
+    assert last.id is not None
+    next_page = nutrition_service.get_recent_analyses(1, before=(last.created_at, last.id))
+    assert [a.id for a in next_page] == [older.id]
+
+    # Rows sharing a timestamp are ordered by id and none is skipped between pages
+    with get_session() as session:
+        for analysis_id in (older.id, newer.id):
+            db_analysis = session.get(NutritionalAnalysis, analysis_id)
+            assert db_analysis is not None
+            db_analysis.created_at = older.created_at
+            session.add(db_analysis)
+        session.commit()
+
+    first_page = nutrition_service.get_recent_analyses(1)
+    assert [a.id for a in first_page] == [newer.id]
+    next_page = nutrition_service.get_recent_analyses(1, before=(older.created_at, newer.id))
+    assert [a.id for a in next_page] == [older.id]
+
+
+def test_update_analysis_total_calories(nutrition_service):
+    """Test total calories are scaled from per-100g calories by the estimated portion."""
+    analysis = NutritionalAnalysis(food_image_id=1)
+    result = {
+        "food_items": ["rice"],
+        "confidence_score": 0.8,
+        "nutritional_info": {"calories": 130.5, "protein_g": 2.7, "fiber_g": 0},
+        "estimated_portion_g": 150,
+    }
+
+    nutrition_service._update_analysis_with_results(None, analysis, result, 42)
+
+    assert analysis.calories == Decimal("130.5")
+    assert analysis.protein_g == Decimal("2.7")
+    assert analysis.fiber_g is None
+    assert analysis.estimated_portion_g == Decimal("150")
+    assert analysis.total_calories == Decimal("195.75")
+    assert analysis.processing_time_ms == 42
+
+
+@asynccontextmanager
+async def _dbrx_endpoint(handler):
+    """Serve `handler` as a chat completions endpoint on a local port and yield its URL."""
+    app = web.Application()
+    app.router.add_post("/chat/completions", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        yield f"http://127.0.0.1:{port}/chat/completions"
+    finally:
+        await close_http_session()
+        await runner.cleanup()
+
+
+def _completion(content: str) -> dict:
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+async def test_analyze_with_ai_over_http():
+    """Test the HTTP endpoint gets the bearer token and JSON body, and the reply content is parsed."""
+    received = []
+    client_ports = set()
+
+    async def handler(request: web.Request) -> web.Response:
+        received.append((request.headers.get("Authorization"), await request.json()))
+        client_ports.add(request.transport.get_extra_info("peername")[1] if request.transport else None)
+        return web.json_response(_completion('```json\n{"food_items": ["apple"], "confidence_score": 0.9}\n```'))
+
+    async with _dbrx_endpoint(handler) as url:
+        service = NutritionAnalysisService(dbrx_url=url, dbrx_token="secret")
+        request = service._build_json_request("aGVsbG8=", "What is this?")
+
+        first = await service._analyze_with_ai(request)
+        second = await service._analyze_with_ai(request)
+
+    assert first == second == {"food_items": ["apple"], "confidence_score": 0.9}
+    assert len(received) == 2
+    auth, body = received[0]
+    assert auth == "Bearer secret"
+    assert body["messages"][0]["content"][1]["image_url"]["url"] == "data:image/jpeg;base64,aGVsbG8="
+    # Both requests went over the same pooled keep-alive connection
+    assert len(client_ports) == 1
+
+
+async def test_analyze_with_ai_http_error():
+    """Test an HTTP error status is treated as a failed analysis."""
+
+    async def handler(request: web.Request) -> web.Response:
+        return web.json_response({"error": "overloaded"}, status=500)
+
+    async with _dbrx_endpoint(handler) as url:
+        service = NutritionAnalysisService(dbrx_url=url)
+        assert await service._analyze_with_ai(service._build_json_request("aGVsbG8=", "What is this?")) is None
+
+
+async def test_complete_caps_concurrent_requests():
+    """Test no more than five DBRX requests are in flight at once."""
+    in_flight = 0
+    peak = 0
+
+    async def handler(request: web.Request) -> web.Response:
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        return web.json_response(_completion("{}"))
+
+    async with _dbrx_endpoint(handler) as url:
+        service = NutritionAnalysisService(dbrx_url=url)
+        request = service._build_json_request("aGVsbG8=", "What is this?")
+        replies = await asyncio.gather(*(service._complete(request) for _ in range(12)))
+
+    assert replies == ["{}"] * 12
+    assert peak == 5
+
+
+async def test_analyze_food_images_chunks_requests(food_image, make_food_image):
+    """Test large batches are split into requests of at most four images with a bounded token budget."""
+    image_ids = [food_image.id] + [make_food_image("red", (40, 40), f"snack{i}.jpg").id for i in range(5)]
+
+    requests = []
+
+    async def handler(request: web.Request) -> web.Response:
+        body = await request.json()
+        count = sum(1 for part in body["messages"][0]["content"] if part["type"] == "image_url")
+        requests.append((count, body["max_tokens"]))
+        result = {"food_items": ["snack"], "confidence_score": 0.5}
+        return web.json_response(_completion(json.dumps({"results": [result] * count})))
+
+    async with _dbrx_endpoint(handler) as url:
+        analyses = await NutritionAnalysisService(dbrx_url=url).analyze_food_images(image_ids)
+
+    assert sorted(requests) == [(2, 4000), (4, 8000)]
+    assert [a.food_image_id for a in analyses if a is not None] == image_ids
+    assert all(a is not None and a.status == AnalysisStatus.COMPLETED for a in analyses)
+
+
+async def test_failed_reanalysis_clears_previous_results(nutrition_service, food_image):
+    """Test re-running an analysis drops the nutrients and allergens of the earlier run."""
+    analysis = await nutrition_service.analyze_food_image(food_image.id)
+    assert analysis is not None
+
+    with get_session() as session:
+        db_analysis = session.get(NutritionalAnalysis, analysis.id)
+        assert db_analysis is not None
+        db_analysis.calories = Decimal("120")
+        db_analysis.total_calories = Decimal("180")
+        nutrition_service._create_allergen_detections(session, db_analysis, [{"name": "nuts", "confidence": 0.8}])
+        session.commit()
+
+    UserService().file_service.delete_image(food_image.file_path)
+    [rerun] = await nutrition_service.analyze_food_images([food_image.id])
+
+    assert rerun is not None and rerun.id == analysis.id
+    assert rerun.status == AnalysisStatus.FAILED
+    assert rerun.calories is None and rerun.total_calories is None
+    assert rerun.food_items == []
+
+    with get_session() as session:
+        detections = session.exec(
+            select(AllergenDetection).where(AllergenDetection.nutritional_analysis_id == analysis.id)
+        ).all()
+        assert detections == []
+
+
+async def test_analyze_food_images_saves_batch_atomically(food_image, make_food_image):
+    """Test a batch whose second result cannot be stored leaves no results of the first one behind."""
+    second_image = make_food_image("blue", (60, 60), "stew.jpg")
+    good = {
+        "food_items": ["nut bar"],
+        "nutritional_info": {"calories": 480},
+        "allergens": [{"name": "nuts", "confidence": 0.9}],
+    }
+    # Allergen names are limited to 100 characters, so storing this result fails
+    bad = {"food_items": ["stew"], "allergens": [{"name": "x" * 150, "confidence": 0.9}]}
+
+    async def handler(request: web.Request) -> web.Response:
+        return web.json_response(_completion(json.dumps({"results": [good, bad]})))
+
+    async with _dbrx_endpoint(handler) as url:
+        first, second = await NutritionAnalysisService(dbrx_url=url).analyze_food_images(
+            [food_image.id, second_image.id]
+        )
+
+    assert first is not None and second is not None
+    assert first.status == second.status == AnalysisStatus.FAILED
+    assert first.calories is None
+    assert first.food_items == []
+    assert "nuts" not in _ALLERGEN_CACHE
+
+    with get_session() as session:
+        detections = session.exec(
+            select(AllergenDetection).where(AllergenDetection.nutritional_analysis_id == first.id)
+        ).all()
+        assert detections == []
+        assert session.exec(select(Allergen)).all() == []
+
+
+async def test_persist_failure_after_flush_error(nutrition_service, food_image):
+    """Test a failure is still recorded when storing the results broke the session."""
+    analysis = await nutrition_service.analyze_food_image(food_image.id)
+    assert analysis is not None
+
+    with get_session() as session:
+        session.expire_on_commit = False
+        db_analysis = session.get(NutritionalAnalysis, analysis.id)
+        assert db_analysis is not None
+
+        # Allergen names are limited to 100 characters, so the insert fails
+        result = {"food_items": ["cake"], "allergens": [{"name": "x" * 150, "confidence": 0.9}]}
+        with pytest.raises(SQLAlchemyError):
+            nutrition_service._persist_results(session, [(db_analysis, result)], 10)
+
+        nutrition_service._persist_failure(session, [db_analysis], "could not store results")
+
+    assert db_analysis.status == AnalysisStatus.FAILED
+    assert db_analysis.error_message == "could not store results"
+
+
+async def test_complete_caps_requests_across_event_loops():
+    """Test the request cap also holds for blocking callers, each running its own event loop."""
+    in_flight = 0
+    peak = 0
+
+    async def handler(request: web.Request) -> web.Response:
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        return web.json_response(_completion("{}"))
+
+    async with _dbrx_endpoint(handler) as url:
+        service = NutritionAnalysisService(dbrx_url=url)
+        request = service._build_json_request("aGVsbG8=", "What is this?")
+
+        async def send_all() -> list[str]:
+            async with _new_http_session() as http_session:
+                return await asyncio.gather(*(service._complete(request, http_session) for _ in range(4)))
+
+        replies = await asyncio.gather(*(asyncio.to_thread(asyncio.run, send_all()) for _ in range(3)))
+
+    assert replies == [["{}"] * 4] * 3
+    assert peak == 5
+    assert nutrition_module._HTTP_SESSION is None
+
+
+async def test_analyze_food_image_sync_uses_own_session(food_image):
+    """Test the blocking wrapper talks to DBRX over its own session and leaves no shared session behind."""
+
+    async def handler(request: web.Request) -> web.Response:
+        return web.json_response(_completion('{"food_items": ["salad"], "confidence_score": 0.7}'))
+
+    async with _dbrx_endpoint(handler) as url:
+        service = NutritionAnalysisService(dbrx_url=url)
+        analysis = await asyncio.to_thread(service.analyze_food_image_sync, food_image.id)
+        assert nutrition_module._HTTP_SESSION is None
+
+    assert analysis is not None
+    assert analysis.status == AnalysisStatus.COMPLETED
+    assert analysis.food_items == ["salad"]
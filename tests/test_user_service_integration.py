@@ -199,6 +199,12 @@ def test_large_image_handling(user_service, new_db):
     assert food_image.width <= user_service.file_service.MAX_IMAGE_SIZE[0]
     assert food_image.height <= user_service.file_service.MAX_IMAGE_SIZE[1]
 
+    # A smaller copy is stored for AI analysis
+    assert food_image.file_path_analysis is not None
+    assert food_image.file_path_analysis != food_image.file_path
+    with Image.open(food_image.file_path_analysis) as analysis_img:
+        assert max(analysis_img.size) <= max(user_service.file_service.ANALYSIS_IMAGE_SIZE)
+
     # Clean up
     user_service.file_service.delete_image(food_image.file_path)
 